@@ -1,5 +1,4 @@
 import faiss
-import json
 import numpy as np
 from pymongo import MongoClient
 from pathlib import Path
@@ -8,42 +7,131 @@ from pathlib import Path
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "synthetic_fhir"
 COLLECTION_NAME = "patients"
+EMBEDDING_DIM = 768  # Bio_ClinicalBERT hidden size
+CURSOR_BATCH_SIZE = 5000  # Documents per MongoDB getMore round-trip
 
 INDEX_DIR = Path(r"D:\capstone project\faiss_index")
 FAISS_INDEX_FILE = INDEX_DIR / "patient.index"
-MAPPING_FILE = INDEX_DIR / "index_mapping.json"
+MAPPING_FILE = INDEX_DIR / "index_mapping.npz"  # row i -> patient_ids[i], vector_ids[i]
+DENSE_MATRIX_FILE = INDEX_DIR / "patients.npy"  # for torch.mm + topk search ("flat" only)
+
+# "hnsw" (graph ANN, sub-linear search), "ivfpq" (inverted lists + product
+# quantization, ~48 bytes/vector) or "flat" (exact). The type actually built
+# is saved in the mapping file; search_index.py queries the index it names.
+INDEX_TYPE = "hnsw"
+HNSW_M = 32  # Graph neighbours per node
+HNSW_EF_CONSTRUCTION = 200
+IVF_NLIST = 1024  # Upper bound on inverted lists; reduced for small corpora
+PQ_M = 16  # Sub-quantizers per vector (768 / 16 = 48 dims each, 8 bits)
+PQ_MIN_TRAIN = 256  # 2**8 centroids per sub-quantizer; smaller corpora fall back to flat
+
+def decode_embedding(doc):
+    """Embedding as a NumPy vector: raw bytes of `embedding_dtype`, or a legacy list."""
+    embedding = doc["embedding"]
+    if isinstance(embedding, bytes):
+        return np.frombuffer(embedding, dtype=doc.get("embedding_dtype", "float32"))
+    return embedding
+
+_gpu_resources = []  # keep GPU memory pools alive while indexes use them
+
+def to_gpu(index):
+    """Move a CPU index onto the available GPU(s); no-op without CUDA."""
+    num_gpus = faiss.get_num_gpus()
+    if num_gpus == 0:
+        return index
+    if num_gpus == 1:
+        _gpu_resources.append(faiss.StandardGpuResources())
+        return faiss.index_cpu_to_gpu(_gpu_resources[-1], 0, index)
+    co = faiss.GpuMultipleClonerOptions()
+    co.shard = True
+    return faiss.index_cpu_to_all_gpus(index, co)
 
 def main():
     client = MongoClient(MONGO_URI)
     collection = client[DB_NAME][COLLECTION_NAME]
 
     print("🔍 Fetching updated embeddings from MongoDB...")
-    cursor = collection.find({"embedding": {"$exists": True}}, {"patient_id": 1, "embedding": 1, "vector_id": 1})
+    query = {"embedding": {"$exists": True}}
+    n = collection.count_documents(query)
+    # Server-side $match/$project; the pipeline is the place to add
+    # $sample/$limit stages when splitting the build across workers.
+    pipeline = [
+        {"$match": query},
+        {"$project": {
+            "_id": 0, "patient_id": 1, "embedding": 1, "embedding_dtype": 1,
+            "vector_id": 1, "normalized": 1
+        }}
+    ]
+    cursor = collection.aggregate(
+        pipeline, batchSize=CURSOR_BATCH_SIZE, allowDiskUse=False
+    )
 
-    embeddings = []
-    index_mapping = {}
+    # Fill a preallocated matrix row by row instead of stacking a list of arrays
+    embeddings = np.empty((n, EMBEDDING_DIM), dtype=np.float32)
+    patient_ids = [None] * n
+    vector_ids = [None] * n
+    unnormalized_rows = []
 
-    for idx, doc in enumerate(cursor):
-        embeddings.append(np.array(doc["embedding"], dtype="float32"))
-        index_mapping[str(idx)] = {
-            "patient_id": doc["patient_id"],
-            "vector_id": doc.get("vector_id")
-        }
+    count = 0
+    with cursor:
+        for idx, doc in enumerate(cursor):
+            if idx >= n:
+                break
+            embeddings[idx] = decode_embedding(doc)
+            if not doc.get("normalized"):
+                unnormalized_rows.append(idx)
+            patient_ids[idx] = doc["patient_id"]
+            vector_ids[idx] = doc.get("vector_id") or ""
+            count = idx + 1
 
-    if not embeddings:
+    if not count:
         print("❌ No embeddings found! Did you run embeddings.py?")
         return
 
-    embeddings = np.vstack(embeddings)
+    embeddings = embeddings[:count]
     
-    # Use Inner Product for Cosine Similarity (requires normalization)
-    faiss.normalize_L2(embeddings)
-    index = faiss.IndexFlatIP(embeddings.shape[1])
+    # Use Inner Product for Cosine Similarity (requires normalization).
+    # embeddings.py stores unit vectors; only legacy documents need it here.
+    if unnormalized_rows:
+        legacy = embeddings[unnormalized_rows]
+        faiss.normalize_L2(legacy)
+        embeddings[unnormalized_rows] = legacy
+
+    index_type = INDEX_TYPE
+    if index_type == "ivfpq" and count < PQ_MIN_TRAIN:
+        print(f"⚠️ IVFPQ needs at least {PQ_MIN_TRAIN} vectors to train, got {count}; building a flat index instead")
+        index_type = "flat"
+
+    if index_type == "hnsw":
+        # HNSW has no GPU implementation; it is built on CPU
+        index = faiss.IndexHNSWFlat(EMBEDDING_DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        cpu_index = index
+    elif index_type == "ivfpq":
+        # ~39 training points per list keeps k-means well conditioned
+        nlist = max(1, min(IVF_NLIST, count // 39))
+        index = faiss.index_factory(
+            EMBEDDING_DIM, f"IVF{nlist},PQ{PQ_M}", faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(embeddings)
+        cpu_index = index
+    else:
+        # Exact search; search_index.py may run it with torch over this matrix
+        np.save(DENSE_MATRIX_FILE, embeddings)
+        cpu_index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        index = to_gpu(cpu_index)
     index.add(embeddings)
 
+    # GPU indexes must be copied back to host memory before serialization
+    if index is not cpu_index:
+        index = faiss.index_gpu_to_cpu(index)
     faiss.write_index(index, str(FAISS_INDEX_FILE))
-    with open(MAPPING_FILE, "w") as f:
-        json.dump(index_mapping, f, indent=2)
+    np.savez(
+        MAPPING_FILE,
+        patient_ids=np.array(patient_ids[:count]),
+        vector_ids=np.array(vector_ids[:count]),
+        index_type=np.array(index_type)
+    )
 
     print(f"✅ FAISS Index built with {index.ntotal} patients.")
 
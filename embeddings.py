@@ -1,5 +1,6 @@
 import os
-import json
+import hashlib
+import orjson
 import time
 import datetime
 from pathlib import Path
@@ -11,7 +12,13 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
 
 import tensorflow as tf
-from pymongo import MongoClient
+
+for gpu in tf.config.list_physical_devices("GPU"):
+    tf.config.experimental.set_memory_growth(gpu, True)
+
+from bson.binary import Binary
+from pymongo import MongoClient, UpdateOne
+from pymongo.write_concern import WriteConcern
 from transformers import AutoTokenizer, TFAutoModel
 from tqdm import tqdm
 
@@ -22,119 +29,251 @@ MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "synthetic_fhir"
 COLLECTION_NAME = "patients"
 
-SENTENCE_FILE = Path(r"D:\capstone project\nlp\patient_sentences.json")
-FAISS_DIR = Path(r"D:\capstone project\faiss_index")
-MAPPING_FILE = FAISS_DIR / "index_mapping.json"
+SENTENCE_FILE = Path(r"D:\capstone project\nlp\patient_sentences.jsonl")
+TOKEN_CACHE_DIR = Path(r"D:\capstone project\nlp\token_cache")
 
 MODEL_NAME = "emilyalsentzer/Bio_ClinicalBERT"
 EMBEDDING_VERSION = "v1"
-BATCH_SIZE = 8  # INCREASED: Process 12 patients per batch
+EMBEDDING_DTYPE = "float32"  # Embeddings are stored in MongoDB as raw bytes of this dtype
+BATCH_SIZE = 32  # Patients per inference batch (tune to available RAM)
 MAX_LENGTH = 512  # Bio_ClinicalBERT limit
+FLUSH_EVERY_BATCHES = 8  # Send MongoDB updates once per 8 embedding batches
+
+# INT8 ONNX Runtime inference (CPU). Export the FP32 graph once with:
+#   optimum-cli export onnx --model emilyalsentzer/Bio_ClinicalBERT <ONNX_DIR>
+# Set USE_ONNX_INT8 = False to fall back to the TensorFlow model.
+USE_ONNX_INT8 = True
+ONNX_DIR = Path(r"D:\capstone project\models\bio_clinicalbert_onnx")
+ONNX_FP32_FILE = ONNX_DIR / "model.onnx"
+ONNX_INT8_FILE = ONNX_DIR / "model_int8.onnx"
 
 # =====================================================
 # 3. INITIALIZE MODEL & DATABASE
 # =====================================================
 print(f"🚀 Loading model: {MODEL_NAME}")
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-model = TFAutoModel.from_pretrained(MODEL_NAME, from_pt=True)
+tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+
+if USE_ONNX_INT8:
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    if not ONNX_INT8_FILE.exists():
+        if not ONNX_FP32_FILE.exists():
+            raise FileNotFoundError(f"❌ Missing ONNX export: {ONNX_FP32_FILE}")
+        print(f"⚙️ Quantizing {ONNX_FP32_FILE.name} to INT8")
+        quantize_dynamic(
+            str(ONNX_FP32_FILE), str(ONNX_INT8_FILE), weight_type=QuantType.QInt8
+        )
+
+    session = ort.InferenceSession(
+        str(ONNX_INT8_FILE), providers=["CPUExecutionProvider"]
+    )
+    session_inputs = {i.name for i in session.get_inputs()}
+    model = None
+else:
+    session = None
+    model = TFAutoModel.from_pretrained(MODEL_NAME, from_pt=True)
 
 mongo_client = MongoClient(MONGO_URI)
 db = mongo_client[DB_NAME]
-patients_col = db[COLLECTION_NAME]
+patients_col = db.get_collection(
+    COLLECTION_NAME, write_concern=WriteConcern(w=1, j=False)
+)
+patients_col.create_index("patient_id", unique=True)
 
 # =====================================================
 # 4. EMBEDDING FUNCTION (MEAN POOLING)
 # =====================================================
-def generate_embeddings(texts):
+_INPUT_SPEC = tf.TensorSpec([None, MAX_LENGTH], tf.int32)
+
+
+@tf.function(jit_compile=True, input_signature=[_INPUT_SPEC] * 3)
+def _forward(input_ids, attention_mask, token_type_ids):
     """
-    Converts a batch of clinical summaries into 768-dim embeddings
-    using attention-mask-aware mean pooling.
+    XLA-compiled forward pass + mean pooling + L2 normalization over
+    fixed-length inputs.
     """
-    inputs = tokenizer(
-        texts,
-        padding=True,
-        truncation=True,
-        max_length=MAX_LENGTH,
-        return_tensors="tf"
-    )
-
-    outputs = model(**inputs)
-    token_embeddings = outputs.last_hidden_state
+    token_embeddings = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        token_type_ids=token_type_ids
+    ).last_hidden_state
 
-    attention_mask = tf.cast(inputs["attention_mask"], tf.float32)
-    mask_expanded = tf.expand_dims(attention_mask, -1)
+    mask_expanded = tf.expand_dims(tf.cast(attention_mask, tf.float32), -1)
 
     summed = tf.reduce_sum(token_embeddings * mask_expanded, axis=1)
     counts = tf.reduce_sum(mask_expanded, axis=1)
 
-    embeddings = summed / tf.maximum(counts, 1e-9)
+    pooled = summed / tf.maximum(counts, 1e-9)
+
+    # L2-normalize so the index can use inner product as cosine similarity
+    return pooled / tf.maximum(tf.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+
+def _generate_embeddings_onnx(input_ids, attention_mask, token_type_ids):
+    """
+    INT8 ONNX Runtime forward pass with mean pooling done in NumPy.
+    """
+    # Trim the cached max_length padding down to the longest row in the batch
+    width = max(int(attention_mask.sum(axis=1).max()), 1)
+    inputs = {
+        "input_ids": input_ids[:, :width],
+        "attention_mask": attention_mask[:, :width],
+        "token_type_ids": token_type_ids[:, :width]
+    }
+    feed = {
+        name: value.astype(np.int64)
+        for name, value in inputs.items() if name in session_inputs
+    }
+
+    token_embeddings = session.run(["last_hidden_state"], feed)[0]
+
+    mask_expanded = inputs["attention_mask"][..., None].astype(np.float32)
+
+    summed = (token_embeddings * mask_expanded).sum(axis=1)
+    counts = mask_expanded.sum(axis=1)
+
+    pooled = summed / np.maximum(counts, 1e-9)
+
+    # L2-normalize so the index can use inner product as cosine similarity
+    return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+
+def generate_embeddings(input_ids, attention_mask, token_type_ids):
+    """
+    Converts a batch of tokenized clinical summaries (padded to MAX_LENGTH)
+    into 768-dim embeddings using attention-mask-aware mean pooling.
+    """
+    if session is not None:
+        return _generate_embeddings_onnx(input_ids, attention_mask, token_type_ids)
+
+    # Fixed-length inputs so the compiled graph is traced only once
+    embeddings = _forward(
+        input_ids.astype(np.int32),
+        attention_mask.astype(np.int32),
+        token_type_ids.astype(np.int32)
+    )
     return embeddings.numpy()
 
+
+def load_or_tokenize(sentences):
+    """
+    Tokenizes all sentences once (padded to MAX_LENGTH) and caches the
+    arrays under TOKEN_CACHE_DIR, keyed by the sentence file, model and
+    max length. Warm runs memory-map the cached arrays instead.
+    """
+    key = hashlib.sha1(
+        SENTENCE_FILE.read_bytes() + f"{MODEL_NAME}|{MAX_LENGTH}".encode()
+    ).hexdigest()
+    files = {
+        "input_ids": TOKEN_CACHE_DIR / f"{key}.ids.npy",
+        "attention_mask": TOKEN_CACHE_DIR / f"{key}.mask.npy",
+        "token_type_ids": TOKEN_CACHE_DIR / f"{key}.types.npy"
+    }
+
+    if all(path.exists() for path in files.values()):
+        print(f"📦 Using cached tokens: {key}")
+        return {name: np.load(path, mmap_mode="r") for name, path in files.items()}
+
+    inputs = tokenizer(
+        sentences,
+        padding="max_length",
+        truncation=True,
+        max_length=MAX_LENGTH,
+        return_tensors="np"
+    )
+    tokens = {
+        "input_ids": inputs["input_ids"].astype(np.int32),
+        "attention_mask": inputs["attention_mask"].astype(np.int8),
+        "token_type_ids": inputs["token_type_ids"].astype(np.int8)
+    }
+
+    TOKEN_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    for name, path in files.items():
+        np.save(path, tokens[name])
+    return tokens
+
 # =====================================================
 # 5. LOAD PATIENT SENTENCES
 # =====================================================
 if not SENTENCE_FILE.exists():
     raise FileNotFoundError(f"❌ Missing file: {SENTENCE_FILE}")
 
-with open(SENTENCE_FILE, "r", encoding="utf-8") as f:
-    patient_data = json.load(f)
+patient_data = [
+    orjson.loads(line) for line in SENTENCE_FILE.read_bytes().splitlines() if line.strip()
+]
 
 print(f"📄 Loaded {len(patient_data)} patient summaries")
 
+tokens = load_or_tokenize([p["sentence"] for p in patient_data])
+
 # =====================================================
 # 6. MAIN PROCESSING LOOP
 # =====================================================
-index_mapping = {}
+pending_ops = []
 start_time = time.time()
 
-# Iterating with the new batch size of 12
-for i in tqdm(range(0, len(patient_data), BATCH_SIZE), desc="Embedding patients"):
-    batch = patient_data[i : i + BATCH_SIZE]
 
-    batch_texts = [p["sentence"] for p in batch]
-    batch_ids = [p["patient_id"] for p in batch]
+def flush_updates(ops):
+    """Send accumulated patient updates to MongoDB in one round-trip."""
+    if ops:
+        patients_col.bulk_write(ops, ordered=False)
+        ops.clear()
+
+
+# Batch sentences of similar token length together so padding stays
+# minimal; results are written back by original position.
+token_lengths = np.asarray(tokens["attention_mask"].sum(axis=1))
+order = np.argsort(token_lengths, kind="stable").tolist()
+
+for i in tqdm(range(0, len(order), BATCH_SIZE), desc="Embedding patients"):
+    batch_idx = order[i : i + BATCH_SIZE]
 
-    vectors = generate_embeddings(batch_texts)
+    batch_texts = [patient_data[k]["sentence"] for k in batch_idx]
+    batch_ids = [patient_data[k]["patient_id"] for k in batch_idx]
+
+    vectors = generate_embeddings(
+        tokens["input_ids"][batch_idx],
+        tokens["attention_mask"][batch_idx],
+        tokens["token_type_ids"][batch_idx]
+    )
 
     for j, vector in enumerate(vectors):
         patient_id = batch_ids[j]
         sentence = batch_texts[j]
 
+        # FAISS row ids are assigned by build_index.py, which saves the
+        # row -> vector_id mapping alongside the index
         vector_id = f"vec_patient-{patient_id}_{EMBEDDING_VERSION}"
-        faiss_index = i + j
-
-        # FAISS numeric index → vector_id mapping
-        index_mapping[str(faiss_index)] = vector_id
 
         # MongoDB update (retain all existing fields)
-        patients_col.update_one(
+        pending_ops.append(UpdateOne(
             {"patient_id": patient_id},
             {
                 "$set": {
                     "vector_id": vector_id,
                     "clinical_sentence": sentence,
-                    "embedding": vector.tolist(),
+                    "embedding": Binary(vector.astype(EMBEDDING_DTYPE).tobytes()),
                     "embedding_dim": len(vector),
+                    "embedding_dtype": EMBEDDING_DTYPE,
+                    "normalized": True,
                     "model_name": MODEL_NAME,
                     "embedding_version": EMBEDDING_VERSION,
                     "last_updated": datetime.datetime.utcnow().isoformat()
                 }
             },
             upsert=False
-        )
+        ))
 
-# =====================================================
-# 7. SAVE FAISS INDEX MAPPING
-# =====================================================
-FAISS_DIR.mkdir(parents=True, exist_ok=True)
+    if (i // BATCH_SIZE + 1) % FLUSH_EVERY_BATCHES == 0:
+        flush_updates(pending_ops)
 
-with open(MAPPING_FILE, "w", encoding="utf-8") as f:
-    json.dump(index_mapping, f, indent=2)
+flush_updates(pending_ops)
 
 # =====================================================
-# 8. FINAL STATUS
+# 7. FINAL STATUS
 # =====================================================
 elapsed = time.time() - start_time
 print("\n✅ Embedding pipeline completed successfully")
 print(f"⏱️ Total time: {elapsed:.2f} seconds")
-print(f"📂 FAISS mapping saved at: {MAPPING_FILE}")
\ No newline at end of file
+print("📂 Run build_index.py to rebuild the FAISS index and its mapping")
\ No newline at end of file
@@ -1,23 +1,24 @@
 # preprocessing/feature_engineering.py
 
-import json
+import orjson
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from datetime import datetime, date
-from fhir_parser import (
-    parse_patient,
-    parse_conditions,
-    parse_encounters,
-    parse_observations
-)
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+from fhir_parser import parse_bundle
 
 # =====================================================
 # PATH CONFIG
 # =====================================================
 
 FHIR_DIR = Path(r"D:\capstone project\synthea_fhir")
-OUTPUT_FILE = Path(r"D:\capstone project\processed\patients_final.json")
+FHIR_FILE = FHIR_DIR / "patients.jsonl"  # Generator output; per-file bundles are the fallback
+OUTPUT_FILE = Path(r"D:\capstone project\processed\patients_final.jsonl")  # One record per line
 OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
 
+WORKER_CHUNKSIZE = 128  # Bundle files handed to a worker process per task
+
 # =====================================================
 # DOMAIN CONFIG
 # =====================================================
@@ -29,6 +30,13 @@ LAB_BOUNDS = {
     "Systolic Blood Pressure": (90, 200)
 }
 
+# Min-max bounds for the scalar ml_features
+FEATURE_BOUNDS = {
+    "age_norm": (18, 90),
+    "visit_count_norm": (1, 15),
+    "lab_count_norm": (0, 20)
+}
+
 SEVERITY_MAP = {
     "mild": 0,
     "moderate": 1,
@@ -54,39 +62,72 @@ CHRONIC_CONDITIONS = {
 # HELPERS
 # =====================================================
 
-def min_max(value, lo, hi):
-    if value is None:
-        return 0
+def min_max(values, lo, hi):
+    """Vectorized min-max scaling of a column of values, rounded to 4 dp."""
     if hi == lo:
-        return 0.0
-    return round((value - lo) / (hi - lo), 4)
+        return [0.0] * len(values)
+    arr = np.asarray(values, dtype=np.float64)
+    return np.round((arr - lo) / (hi - lo), 4).tolist()
+
+_TODAY = date.today()
 
-def calculate_age(birth_date):
+def calculate_age(birth_date: Optional[str]) -> int:
     if not birth_date:
         return 0
-    birth = datetime.strptime(birth_date, "%Y-%m-%d").date()
-    today = date.today()
-    return today.year - birth.year - ((today.month, today.day) < (birth.month, birth.day))
+    # birth_date is ISO "YYYY-MM-DD"; slice instead of strptime
+    year, month, day = int(birth_date[0:4]), int(birth_date[5:7]), int(birth_date[8:10])
+    return _TODAY.year - year - ((_TODAY.month, _TODAY.day) < (month, day))
+
+# Typed helpers over plain lists (no dict-of-dict access), so they can be
+# compiled with mypyc or ported to numba without touching build_features.
+
+def has_chronic_condition(names: List[str]) -> int:
+    for name in names:
+        if name in CHRONIC_CONDITIONS:
+            return 1
+    return 0
+
+def highest_severity(severities: List[str]) -> int:
+    highest = 0
+    for severity in severities:
+        level = SEVERITY_MAP.get(severity.lower(), 0)
+        if level > highest:
+            highest = level
+    return highest
+
+def aggregate_labs(labs: List[str], values: List[float]) -> Dict[str, float]:
+    """Mean of the non-zero values of each bounded lab (0 if none)."""
+    totals: Dict[str, float] = {}
+    counts: Dict[str, int] = {}
+    for lab, value in zip(labs, values):
+        if lab not in LAB_BOUNDS:
+            continue
+        if lab not in totals:
+            totals[lab] = 0.0
+            counts[lab] = 0
+        if value > 0:
+            totals[lab] += value
+            counts[lab] += 1
+    return {
+        lab: totals[lab] / counts[lab] if counts[lab] else 0
+        for lab in totals
+    }
 
 # =====================================================
 # FEATURE ENGINEERING
 # =====================================================
 
-def build_features(bundle):
+def build_features(bundle: dict) -> Tuple[Optional[dict], int, int, bool]:
     missing_value_count = 0          # nulls + missing observations
     replaced_with_zero_count = 0     # only null -> 0
     patient_has_missing = False
 
-    patient = parse_patient(bundle)
+    patient, conditions, encounters, observations = parse_bundle(bundle)
     if not patient:
         return None, 0, 0, False
 
     patient_numeric_id = patient["id"].split("-")[-1]
 
-    conditions = parse_conditions(bundle)
-    encounters = parse_encounters(bundle)
-    observations = parse_observations(bundle)
-
     # =================================================
     # HANDLE MISSING OBSERVATIONS
     # =================================================
@@ -112,41 +153,35 @@ def build_features(bundle):
     visit_count = len(encounters)
     lab_count = len(observations)
 
-    chronic_flag = int(any(c["name"] in CHRONIC_CONDITIONS for c in conditions))
+    chronic_flag = has_chronic_condition([c["name"] for c in conditions])
     active_status = patient.get("active")
 
-    max_severity = max(
-        (SEVERITY_MAP.get(c["severity"].lower()) for c in conditions if c.get("severity")),
-        default=0
+    max_severity = highest_severity(
+        [c["severity"] for c in conditions if c.get("severity")]
     )
 
     # =================================================
     # LAB AGGREGATION
     # =================================================
 
-    lab_values = {}
-    for obs in observations:
-        lab_values.setdefault(obs["lab"], []).append(obs["value"])
-
-    normalized_labs = {}
-    for lab, values in lab_values.items():
-        if lab in LAB_BOUNDS:
-            non_zero = [v for v in values if v > 0]
-            avg = sum(non_zero) / len(non_zero) if non_zero else 0
-            lo, hi = LAB_BOUNDS[lab]
-            normalized_labs[lab] = min_max(avg, lo, hi)
+    lab_averages = aggregate_labs(
+        [obs["lab"] for obs in observations],
+        [obs["value"] for obs in observations]
+    )
 
     # =================================================
     # OUTPUT RECORD
     # =================================================
 
+    # *_norm fields hold raw values here; normalize_features() scales them
+    # across all records once every file has been processed.
     record = {
         "patient_id": patient_numeric_id,
         "ml_features": {
-            "age_norm": min_max(age, 18, 90),
-            "visit_count_norm": min_max(visit_count, 1, 15),
-            "lab_count_norm": min_max(lab_count, 0, 20),
-            "lab_values_norm": normalized_labs,
+            "age_norm": age,
+            "visit_count_norm": visit_count,
+            "lab_count_norm": lab_count,
+            "lab_values_norm": lab_averages,
             "chronic_flag": chronic_flag,
             "max_severity": max_severity
         },
@@ -161,6 +196,50 @@ def build_features(bundle):
 
     return record, missing_value_count, replaced_with_zero_count, patient_has_missing
 
+def normalize_features(records):
+    """Min-max scale the raw ml_features of all records in place, per column."""
+    features = [r["ml_features"] for r in records]
+
+    for key, (lo, hi) in FEATURE_BOUNDS.items():
+        scaled = min_max([f[key] for f in features], lo, hi)
+        for f, value in zip(features, scaled):
+            f[key] = value
+
+    # One pass gathers each lab's values (and the dicts they came from),
+    # then every lab column is scaled in a single NumPy op and scattered back
+    lab_values = {lab: [] for lab in LAB_BOUNDS}
+    lab_owners = {lab: [] for lab in LAB_BOUNDS}
+    for f in features:
+        for lab, value in f["lab_values_norm"].items():
+            lab_values[lab].append(value)
+            lab_owners[lab].append(f["lab_values_norm"])
+
+    for lab, (lo, hi) in LAB_BOUNDS.items():
+        scaled = min_max(lab_values[lab], lo, hi)
+        for owner, value in zip(lab_owners[lab], scaled):
+            owner[lab] = value
+
+def process_bundle(raw):
+    """Parse one serialized FHIR bundle and build its features (worker process)."""
+    try:
+        # orjson parses the raw UTF-8 bytes directly; no text decode pass
+        bundle = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
+        return None, f"{type(e).__name__}: {e}"
+
+    try:
+        return build_features(bundle), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def process_file(path):
+    """Read one per-patient bundle file and build its features (worker process)."""
+    try:
+        raw = path.read_bytes()
+    except OSError as e:
+        return None, f"{type(e).__name__}: {e}"
+    return process_bundle(raw)
+
 # =====================================================
 # MAIN
 # =====================================================
@@ -172,31 +251,42 @@ def main():
     total_replaced_with_zero = 0
     patients_with_missing = 0
 
-    files = list(FHIR_DIR.glob("patient_*.json"))
-    print(f"Found {len(files)} patient files in {FHIR_DIR}")
-
-    for idx, file in enumerate(files, start=1):
-        try:
-            with open(file, "r", encoding="utf-8", errors="ignore") as f:
-                bundle = json.load(f)
-
-            record, missing, replaced, has_missing = build_features(bundle)
-
-            if record:
-                records.append(record)
-                total_missing_values += missing
-                total_replaced_with_zero += replaced
-                if has_missing:
-                    patients_with_missing += 1
-
-        except Exception as e:
-            print(f"[SKIPPED] {file.name} → {type(e).__name__}: {e}")
-
-        if idx % 1000 == 0:
-            print(f"Processed {idx}/{len(files)} files")
-
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(records, f, indent=2)
+    if FHIR_FILE.exists():
+        # One sequential read of the JSONL stream, one bundle per line
+        lines = FHIR_FILE.read_bytes().splitlines()
+        sources = [line for line in lines if line.strip()]
+        labels = [f"{FHIR_FILE.name}:{n}" for n, line in enumerate(lines, start=1) if line.strip()]
+        worker = process_bundle
+        print(f"Found {len(sources)} patient bundles in {FHIR_FILE}")
+    else:
+        sources = list(FHIR_DIR.glob("patient_*.json"))
+        labels = [file.name for file in sources]
+        worker = process_file
+        print(f"Found {len(sources)} patient files in {FHIR_DIR}")
+
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(worker, sources, chunksize=WORKER_CHUNKSIZE)
+
+        for idx, (label, (result, error)) in enumerate(zip(labels, results), start=1):
+            if error:
+                print(f"[SKIPPED] {label} → {error}")
+            else:
+                record, missing, replaced, has_missing = result
+
+                if record:
+                    records.append(record)
+                    total_missing_values += missing
+                    total_replaced_with_zero += replaced
+                    if has_missing:
+                        patients_with_missing += 1
+
+            if idx % 1000 == 0:
+                print(f"Processed {idx}/{len(sources)} bundles")
+
+    normalize_features(records)
+
+    with open(OUTPUT_FILE, "wb") as f:
+        f.writelines(orjson.dumps(record) + b"\n" for record in records)
 
     # =================================================
     # FINAL REPORT
@@ -1,64 +1,71 @@
 # preprocessing/fhir_parser.py
 
-def parse_patient(bundle):
-    for entry in bundle.get("entry", []):
-        res = entry.get("resource", {})
-        if res.get("resourceType") == "Patient":
+# Shared read-only default for optional nested objects (never mutated)
+_EMPTY = {}
+
+
+def parse_bundle(bundle):
+    """
+    Single pass over the bundle entries.
+    Returns (patient, conditions, encounters, observations).
+    """
+    patient = None
+    conditions = []
+    encounters = []
+    observations = []
+
+    # Local aliases keep attribute lookups out of the loop
+    add_condition = conditions.append
+    add_encounter = encounters.append
+    add_observation = observations.append
+
+    # entry/resource/resourceType are required in our bundles; index them
+    # directly and keep .get() for optional fields only
+    for entry in bundle["entry"]:
+        res = entry["resource"]
+        resource_type = res["resourceType"]
+
+        if resource_type == "Observation":
+            add_observation({
+                "lab": res["code"]["coding"][0]["display"],
+                "value": res.get("valueQuantity", _EMPTY).get("value"),
+                "date": res.get("effectiveDateTime"),
+                "encounter_id": res.get("encounter", _EMPTY)
+                                    .get("reference", "")
+                                    .replace("Encounter/", "")
+            })
+
+        elif resource_type == "Encounter":
+            period = res.get("period", _EMPTY)
+            add_encounter({
+                "id": res.get("id"),
+                "status": res.get("status"),
+                "start_date": period.get("start"),
+                "end_date": period.get("end"),  # None if ongoing
+                "last_updated": res.get("meta", _EMPTY).get("lastUpdated")
+            })
+
+        elif resource_type == "Condition":
+            add_condition({
+                "name": res["code"]["coding"][0]["display"],
+                "severity": res.get("severity", _EMPTY).get("text"),
+                "status": res["clinicalStatus"]["coding"][0]["code"]
+            })
+
+        elif resource_type == "Patient" and patient is None:
             ongoing_care = False
-            for ext in res.get("extension", []):
+            for ext in res.get("extension", ()):
                 if ext.get("url") == "ongoing-care":
                     ongoing_care = ext.get("valueBoolean", False)
 
-            return {
+            patient = {
                 "id": res.get("id"),
                 "gender": res.get("gender"),
                 "birthDate": res.get("birthDate"),
                 "ongoing_care": int(ongoing_care),
-                "last_updated": res.get("meta", {}).get("lastUpdated"),
+                "last_updated": res.get("meta", _EMPTY).get("lastUpdated"),
                 "record_start": res.get("_recordStart")
             }
-    return None
-
-
-def parse_conditions(bundle):
-    conditions = []
-    for entry in bundle.get("entry", []):
-        res = entry.get("resource", {})
-        if res.get("resourceType") == "Condition":
-            conditions.append({
-                "name": res["code"]["coding"][0]["display"],
-                "severity": res.get("severity", {}).get("text"),
-                "status": res["clinicalStatus"]["coding"][0]["code"]
-            })
-    return conditions
-
-
-def parse_encounters(bundle):
-    encounters = []
-    for entry in bundle.get("entry", []):
-        res = entry.get("resource", {})
-        if res.get("resourceType") == "Encounter":
-            encounters.append({
-                "id": res.get("id"),
-                "status": res.get("status"),
-                "start_date": res.get("period", {}).get("start"),
-                "end_date": res.get("period", {}).get("end"),  # None if ongoing
-                "last_updated": res.get("meta", {}).get("lastUpdated")
-            })
-    return encounters
 
+    return patient, conditions, encounters, observations
 
-def parse_observations(bundle):
-    observations = []
-    for entry in bundle.get("entry", []):
-        res = entry.get("resource", {})
-        if res.get("resourceType") == "Observation":
-            observations.append({
-                "lab": res["code"]["coding"][0]["display"],
-                "value": res.get("valueQuantity", {}).get("value"),
-                "date": res.get("effectiveDateTime"),
-                "encounter_id": res.get("encounter", {})
-                                    .get("reference", "")
-                                    .replace("Encounter/", "")
-            })
-    return observations
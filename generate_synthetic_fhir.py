@@ -1,7 +1,9 @@
-import json
-import random
+import os
 import uuid
 import argparse
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from datetime import date, timedelta
 from pathlib import Path
 import numpy as np
@@ -10,6 +12,8 @@ import numpy as np
 
 OUTPUT_DIR = Path(r"D:\capstone project\synthea_fhir")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+OUTPUT_FILE = OUTPUT_DIR / "patients.jsonl"  # One bundle per line
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB sequential write buffer
 
 MIN_VISITS = 3
 MAX_VISITS = 8
@@ -18,6 +22,7 @@ NOISE_STD = 0.05
 ONGOING_VISIT_PROB = 0.4   # probability that latest visit is ongoing
 
 SEVERITIES = ["mild", "moderate", "severe"]
+GENDERS = ["male", "female"]
 
 # MEDICAL KNOWLEDGE
 
@@ -43,6 +48,8 @@ LABS = {
     "Total Cholesterol": ("2093-3", "mg/dL", (150, 320))
 }
 
+CONDITION_NAMES = list(CONDITIONS)
+
 CONDITION_LABS = {
     "Type 2 Diabetes Mellitus": ["Hemoglobin A1c"],
     "Hypertension": ["Systolic Blood Pressure"],
@@ -50,156 +57,180 @@ CONDITION_LABS = {
     "Hyperlipidemia": ["Total Cholesterol"]
 }
 
+# Constant FHIR subtrees, built once and shared by every resource.
+# Bundles are only serialized after generation, never mutated, so sharing is safe.
+
+LAB_CODE_TEMPLATES = {
+    lab: {"coding": [{"code": loinc, "display": lab}]}
+    for lab, (loinc, _, _) in LABS.items()
+}
+LAB_UNITS = {lab: unit for lab, (_, unit, _) in LABS.items()}
+
+CONDITION_CODE_TEMPLATES = {
+    name: {"coding": [{"code": icd, "display": name}]}
+    for name, icd in CONDITIONS.items()
+}
+CLINICAL_STATUS_TEMPLATES = {
+    True: {"coding": [{"code": "active"}]},
+    False: {"coding": [{"code": "resolved"}]}
+}
+SEVERITY_TEMPLATES = {severity: {"text": severity} for severity in SEVERITIES}
+
 # HELPERS
 
-def random_birthdate():
-    age = random.randint(30, 85)
+# Every draw comes from the numpy Generator passed in as `rng`;
+# integers() has an exclusive upper bound, hence the +1s
+
+def random_birthdate(rng):
+    age = int(rng.integers(30, 86))
     return date.today() - timedelta(days=365 * age)
 
-def patient_dates():
-    entry = date.today() - timedelta(days=random.randint(500, 2500))
+def patient_dates(rng):
+    entry = date.today() - timedelta(days=int(rng.integers(500, 2501)))
     last_updated = date.today()
     return entry, last_updated
 
-def visit_dates(start, n):
-    return sorted(start + timedelta(days=random.randint(0, 900)) for _ in range(n))
-
-def noisy(value):
-    return round(value * (1 + np.random.normal(0, NOISE_STD)), 2)
+def visit_dates(rng, start, n):
+    offsets = np.sort(rng.integers(0, 901, size=n))
+    return [start + timedelta(days=int(offset)) for offset in offsets]
 
 # FHIR BUILDERS
+# Dates stay `date` objects; orjson writes them as ISO-8601 strings
 
-def fhir_patient(pid, record_start, last_updated, has_ongoing_visit):
+def fhir_patient(rng, pid, record_start, last_updated, has_ongoing_visit):
     return {
         "resourceType": "Patient",
         "id": pid,
-        "gender": random.choice(["male", "female"]),
-        "birthDate": random_birthdate().isoformat(),
-        "meta": {"lastUpdated": last_updated.isoformat()},
+        "gender": GENDERS[rng.integers(0, len(GENDERS))],
+        "birthDate": random_birthdate(rng),
+        "meta": {"lastUpdated": last_updated},
         "extension": [{
             "url": "ongoing-care",
             "valueBoolean": has_ongoing_visit
         }],
-        "_recordStart": record_start.isoformat()
+        "_recordStart": record_start
     }
 
-def fhir_condition(name, icd, severity, ongoing):
+def fhir_condition(name, severity, ongoing):
     return {
         "resourceType": "Condition",
-        "clinicalStatus": {
-            "coding": [{
-                "code": "active" if ongoing else "resolved"
-            }]
-        },
-        "severity": {"text": severity},
-        "code": {
-            "coding": [{
-                "code": icd,
-                "display": name
-            }]
-        }
+        "clinicalStatus": CLINICAL_STATUS_TEMPLATES[bool(ongoing)],
+        "severity": SEVERITY_TEMPLATES[severity],
+        "code": CONDITION_CODE_TEMPLATES[name]
     }
 
-def fhir_encounter(eid, visit_date, is_latest):
-    if is_latest and random.random() < ONGOING_VISIT_PROB:
+def fhir_encounter(rng, eid, visit_date, is_latest):
+    if is_latest and rng.random() < ONGOING_VISIT_PROB:
         # Ongoing visit
         return {
             "resourceType": "Encounter",
             "id": eid,
             "status": "in-progress",
             "period": {
-                "start": visit_date.isoformat()
+                "start": visit_date
             },
             "meta": {
-                "lastUpdated": date.today().isoformat()
+                "lastUpdated": date.today()
             }
         }
     else:
         # Finished visit
-        discharge_date = visit_date + timedelta(days=random.randint(0, 2))
+        discharge_date = visit_date + timedelta(days=int(rng.integers(0, 3)))
         return {
             "resourceType": "Encounter",
             "id": eid,
             "status": "finished",
             "period": {
-                "start": visit_date.isoformat(),
-                "end": discharge_date.isoformat()
+                "start": visit_date,
+                "end": discharge_date
             },
             "meta": {
-                "lastUpdated": discharge_date.isoformat()
+                "lastUpdated": discharge_date
             }
         }
 
-def fhir_observation(lab, visit_date):
-    if random.random() < MISSING_DATA_PROB:
-        return None
-
-    loinc, unit, (low, high) = LABS[lab]
+def fhir_observation(lab, visit_date, value):
     return {
         "resourceType": "Observation",
-        "effectiveDateTime": visit_date.isoformat(),
-        "code": {
-            "coding": [{
-                "code": loinc,
-                "display": lab
-            }]
-        },
+        "effectiveDateTime": visit_date,
+        "code": LAB_CODE_TEMPLATES[lab],
         "valueQuantity": {
-            "value": noisy(random.uniform(low, high)),
-            "unit": unit
+            "value": value,
+            "unit": LAB_UNITS[lab]
         }
     }
 
+def draw_lab_values(rng, n_visits, labs):
+    """
+    Noisy lab values and missing-data mask for every (visit, lab) pair,
+    drawn as whole arrays instead of one scalar RNG call per observation.
+    """
+    bounds = np.array([LABS[lab][2] for lab in labs], dtype=float).reshape(-1, 2)
+    shape = (n_visits, len(labs))
+
+    base = rng.uniform(bounds[:, 0], bounds[:, 1], size=shape)
+    noise = rng.normal(0, NOISE_STD, size=shape)
+    missing = rng.random(shape) < MISSING_DATA_PROB
+
+    return np.round(base * (1 + noise), 2).tolist(), missing.tolist()
+
 # GENERATOR
 
-def generate_patient_bundle(idx):
+def generate_patient_bundle(idx, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
     pid = f"patient-{idx:04d}"
     entries = []
 
-    record_start, last_updated = patient_dates()
-    visits = visit_dates(record_start, random.randint(MIN_VISITS, MAX_VISITS))
+    record_start, last_updated = patient_dates(rng)
+    visits = visit_dates(rng, record_start, int(rng.integers(MIN_VISITS, MAX_VISITS + 1)))
     last_index = len(visits) - 1
 
     # Decide if patient has ongoing visit
-    has_ongoing_visit = random.random() < ONGOING_VISIT_PROB
+    has_ongoing_visit = rng.random() < ONGOING_VISIT_PROB
 
-    patient = fhir_patient(pid, record_start, last_updated, has_ongoing_visit)
+    patient = fhir_patient(rng, pid, record_start, last_updated, has_ongoing_visit)
     entries.append({"resource": patient})
 
-    selected_conditions = random.sample(
-        list(CONDITIONS.items()),
-        random.randint(2, 4)
-    )
+    selected_conditions = [
+        CONDITION_NAMES[i]
+        for i in rng.choice(len(CONDITION_NAMES), size=int(rng.integers(2, 5)), replace=False)
+    ]
 
-    severities = {c[0]: random.choice(SEVERITIES) for c in selected_conditions}
+    severities = {
+        name: SEVERITIES[rng.integers(0, len(SEVERITIES))] for name in selected_conditions
+    }
 
-    for name, icd in selected_conditions:
+    for name in selected_conditions:
         entries.append({
             "resource": fhir_condition(
                 name,
-                icd,
                 severities[name],
                 has_ongoing_visit
             )
         })
 
+    patient_labs = [
+        lab for condition in severities for lab in CONDITION_LABS.get(condition, [])
+    ]
+    lab_values, lab_missing = draw_lab_values(rng, len(visits), patient_labs)
+
     for i, v in enumerate(visits):
         enc_id = f"enc-{pid}-{i}"
-        encounter = fhir_encounter(enc_id, v, i == last_index and has_ongoing_visit)
+        encounter = fhir_encounter(rng, enc_id, v, i == last_index and has_ongoing_visit)
         entries.append({"resource": encounter})
 
         # Only generate labs for finished encounters
         if encounter["status"] == "finished":
-            for condition in severities:
-                for lab in CONDITION_LABS.get(condition, []):
-                    obs = fhir_observation(lab, v)
-                    if obs:
-                        obs["encounter"] = {"reference": f"Encounter/{enc_id}"}
-                        entries.append({"resource": obs})
+            for j, lab in enumerate(patient_labs):
+                if lab_missing[i][j]:
+                    continue
+                obs = fhir_observation(lab, v, lab_values[i][j])
+                obs["encounter"] = {"reference": f"Encounter/{enc_id}"}
+                entries.append({"resource": obs})
 
     return {
         "resourceType": "Bundle",
-        "id": str(uuid.uuid4()),
+        "id": str(uuid.UUID(bytes=rng.bytes(16), version=4)),
         "type": "collection",
         "entry": entries
     }
@@ -214,14 +245,33 @@ def parse_args():
         default=100,
         help="Number of patients to generate"
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Base seed for reproducible output (random if omitted)"
+    )
     return parser.parse_args()
 
+def _worker(i, base_seed=None):
+    # One Generator per patient: forked workers would otherwise share RNG
+    # state, and a base seed makes each patient reproducible regardless of worker
+    seq = np.random.SeedSequence(None if base_seed is None else [base_seed, i])
+    return orjson.dumps(generate_patient_bundle(i, np.random.default_rng(seq)))
+
 if __name__ == "__main__":
     args = parse_args()
 
-    for i in range(1, args.num_patients + 1):
-        bundle = generate_patient_bundle(i)
-        with open(OUTPUT_DIR / f"patient_{i:04d}.json", "w") as f:
-            json.dump(bundle, f, indent=2)
-
-    print(f"Generated {args.num_patients} synthetic FHIR patient bundles at {OUTPUT_DIR}")
+    # Workers build and serialize bundles; the parent appends them in
+    # patient order to a single JSONL file
+    with open(OUTPUT_FILE, "wb", buffering=WRITE_BUFFER_SIZE) as out, \
+            ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for line in executor.map(
+            partial(_worker, base_seed=args.seed),
+            range(1, args.num_patients + 1),
+            chunksize=64
+        ):
+            out.write(line)
+            out.write(b"\n")
+
+    print(f"Generated {args.num_patients} synthetic FHIR patient bundles at {OUTPUT_FILE}")
@@ -1,6 +1,6 @@
 # mongodb/store_patients_mongo.py
 
-import json
+import orjson
 from pathlib import Path
 from pymongo import MongoClient
 
@@ -8,10 +8,11 @@ from pymongo import MongoClient
 # CONFIG
 # =====================================================
 
-INPUT_FILE = Path(r"D:\capstone project\processed\patients_final.json")
+INPUT_FILE = Path(r"D:\capstone project\processed\patients_final.jsonl")
 MONGO_URI = "mongodb://localhost:27017/"   # Change if needed
 DB_NAME = "synthetic_fhir"
 COLLECTION_NAME = "patients"
+INSERT_BATCH_SIZE = 1000  # Documents per insert_many round-trip
 
 # =====================================================
 # CONNECT TO MONGO
@@ -32,8 +33,9 @@ print(f"Existing collection '{COLLECTION_NAME}' dropped. Starting fresh.")
 if not INPUT_FILE.is_file():
     raise FileNotFoundError(f"{INPUT_FILE} does not exist. Run feature_engineering.py first!")
 
-with open(INPUT_FILE, "r", encoding="utf-8") as f:
-    patients = json.load(f)
+patients = [
+    orjson.loads(line) for line in INPUT_FILE.read_bytes().splitlines() if line.strip()
+]
 
 print(f"Loaded {len(patients)} patients from {INPUT_FILE}")
 
@@ -41,9 +43,11 @@ print(f"Loaded {len(patients)} patients from {INPUT_FILE}")
 # INSERT INTO MONGODB
 # =====================================================
 
-for patient in patients:
-    # Ensure MongoDB-friendly structure
-    collection.insert_one(patient)
+# Index the lookup key used by embeddings.py and search_index.py
+collection.create_index("patient_id", unique=True)
+
+for i in range(0, len(patients), INSERT_BATCH_SIZE):
+    collection.insert_many(patients[i : i + INSERT_BATCH_SIZE], ordered=False)
 
 print(f" All {len(patients)} patients inserted into MongoDB collection '{COLLECTION_NAME}'")
 print(f"DB: '{DB_NAME}', URI: '{MONGO_URI}'")
@@ -1,5 +1,4 @@
 import faiss
-import json
 import numpy as np
 from pymongo import MongoClient
 from pathlib import Path
@@ -12,8 +11,26 @@ COLLECTION_NAME = "patients"
 
 INDEX_DIR = Path(r"D:\capstone project\faiss_index")
 FAISS_INDEX_FILE = INDEX_DIR / "patient.index"
-MAPPING_FILE = INDEX_DIR / "index_mapping.json"
+MAPPING_FILE = INDEX_DIR / "index_mapping.npz"
+DENSE_MATRIX_FILE = INDEX_DIR / "patients.npy"
 
+# For a "flat" build, run the exact top-k via torch.mm + torch.topk over the
+# normalized matrix (BLAS GEMM); set False to query the flat FAISS index.
+# "hnsw" / "ivfpq" builds (build_index.INDEX_TYPE) always use the FAISS index.
+USE_TORCH_SEARCH = True
+TOP_K = 6  # Self + top 5
+HNSW_EF_SEARCH = 64  # Candidate list size for HNSW indexes (recall vs speed)
+IVF_NPROBE = 16  # Inverted lists scanned per query for IVF indexes
+
+
+def torch_search(queries, k):
+    """Inner-product top-k of `queries` against the saved embedding matrix."""
+    import torch
+
+    matrix = torch.from_numpy(np.load(DENSE_MATRIX_FILE))
+    scores = torch.mm(torch.from_numpy(queries), matrix.T)
+    values, indices = torch.topk(scores, k=min(k, matrix.shape[0]), dim=1)
+    return values.numpy(), indices.numpy()
 
 
 def main():
@@ -24,30 +41,62 @@ def main():
     collection = client[DB_NAME][COLLECTION_NAME]
 
     # Find the target patient
-    patient = collection.find_one({"patient_id": patient_id})
+    patient = collection.find_one(
+        {"patient_id": patient_id},
+        {"_id": 0, "embedding": 1, "embedding_dtype": 1, "normalized": 1}
+    )
     if not patient or "embedding" not in patient:
         print(f"❌ Patient {patient_id} not found or missing embedding.")
         return
 
-    # Load FAISS and Mapping
-    index = faiss.read_index(str(FAISS_INDEX_FILE))
-    with open(MAPPING_FILE) as f:
-        index_mapping = json.load(f)
+    # Load Mapping
+    with np.load(MAPPING_FILE) as mapping:
+        patient_ids = mapping["patient_ids"]
+        # Mappings saved before the index type was recorded: use the index
+        index_type = str(mapping["index_type"]) if "index_type" in mapping.files else None
 
     # Search Logic
-    search_vector = np.array(patient["embedding"], dtype="float32").reshape(1, -1)
-    faiss.normalize_L2(search_vector)
-    distances, indices = index.search(search_vector, 6) # Self + top 5
+    embedding = patient["embedding"]
+    if isinstance(embedding, bytes):
+        embedding = np.frombuffer(embedding, dtype=patient.get("embedding_dtype", "float32"))
+    search_vector = np.array(embedding, dtype="float32").reshape(1, -1)
+    if patient.get("normalized"):
+        # Stored unit-norm by embeddings.py; checked only in debug runs
+        assert abs(np.linalg.norm(search_vector) - 1) < 1e-5
+    else:
+        faiss.normalize_L2(search_vector)
+    if USE_TORCH_SEARCH and index_type == "flat":
+        distances, indices = torch_search(search_vector, TOP_K)
+    else:
+        index = faiss.read_index(str(FAISS_INDEX_FILE))
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        if hasattr(index, "nprobe"):
+            index.nprobe = IVF_NPROBE
+        distances, indices = index.search(search_vector, TOP_K)
 
-    results = []
+    sim_hits = []
     for dist, idx in zip(distances[0], indices[0]):
-        map_data = index_mapping.get(str(idx))
-        if not map_data or map_data["patient_id"] == patient_id:
+        # FAISS pads missing neighbours with -1
+        if not 0 <= idx < len(patient_ids):
             continue
-        
-        sim_id = map_data["patient_id"]
-        sim_doc = collection.find_one({"patient_id": sim_id})
-        
+
+        sim_id = str(patient_ids[idx])
+        if sim_id != patient_id:
+            sim_hits.append((sim_id, dist))
+
+    # One round-trip for all neighbours, fetching only the summary field
+    sim_docs = {
+        doc["patient_id"]: doc
+        for doc in collection.find(
+            {"patient_id": {"$in": [sim_id for sim_id, _ in sim_hits]}},
+            {"_id": 0, "patient_id": 1, "clinical_sentence": 1}
+        )
+    }
+
+    results = []
+    for sim_id, dist in sim_hits:
+        sim_doc = sim_docs.get(sim_id, {})
         results.append([
             sim_id,
             f"{dist:.4f}",
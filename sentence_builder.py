@@ -1,8 +1,8 @@
 # sentence_builder.py
 
-import json
+import orjson
 from pymongo import MongoClient
-from datetime import datetime
+from datetime import date
 from pathlib import Path
 
 # =====================================================
@@ -12,8 +12,10 @@ from pathlib import Path
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "synthetic_fhir"
 COLLECTION_NAME = "patients"
+CURSOR_BATCH_SIZE = 1000  # Documents per MongoDB getMore round-trip
 
-OUTPUT_FILE = Path(r"D:\capstone project\patient_sentences.json")
+OUTPUT_FILE = Path(r"D:\capstone project\patient_sentences.jsonl")  # One sentence record per line
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB sequential write buffer
 OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
 
 # =====================================================
@@ -35,13 +37,15 @@ def is_valid(value):
     return value not in (None, 0, "", [], {})
 
 
+_TODAY = date.today()
+
+
 def calculate_age(birth_date):
     if not is_valid(birth_date):
         return None
-    birth = datetime.strptime(birth_date, "%Y-%m-%d").date()
-    today = datetime.today().date()
-    return today.year - birth.year - (
-        (today.month, today.day) < (birth.month, birth.day)
+    birth = date.fromisoformat(birth_date)
+    return _TODAY.year - birth.year - (
+        (_TODAY.month, _TODAY.day) < (birth.month, birth.day)
     )
 
 # =====================================================
@@ -109,32 +113,35 @@ def build_patient_sentence(patient):
 # =====================================================
 
 def main(limit=None):
-    cursor = collection.find()
+    # Fetch only the fields build_patient_sentence reads, and let the server
+    # drop patients without a narrative so they are never sent or decoded
+    # (they no longer show up in the skipped count below)
+    cursor = collection.find(
+        {"narrative_fields": {"$exists": True, "$ne": {}}},
+        {"_id": 0, "patient_id": 1, "narrative_fields": 1}
+    ).batch_size(CURSOR_BATCH_SIZE)
     if limit:
         cursor = cursor.limit(limit)
 
-    sentences_output = []
-
     total = 0
     generated = 0
     skipped = 0
 
-    for patient in cursor:
-        total += 1
-        sentence = build_patient_sentence(patient)
-
-        if sentence:
-            generated += 1
-            sentences_output.append({
-                "patient_id": patient.get("patient_id"),
-                "sentence": sentence
-            })
-        else:
-            skipped += 1
-
-    # -------- SAVE FILE --------
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(sentences_output, f, indent=2)
+    # -------- STREAM TO FILE --------
+    with open(OUTPUT_FILE, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        for patient in cursor:
+            total += 1
+            sentence = build_patient_sentence(patient)
+
+            if sentence:
+                generated += 1
+                f.write(orjson.dumps({
+                    "patient_id": patient.get("patient_id"),
+                    "sentence": sentence
+                }))
+                f.write(b"\n")
+            else:
+                skipped += 1
 
     # -------- SUMMARY --------
     print("\nSUMMARY")